@@ -251,17 +251,80 @@ static int search_backward(struct pane *p safe,
 	return maxlen;
 }
 
+/* The same pattern is often searched for repeatedly, such as when
+ * finding each URL in a message, so keep the few most recently parsed.
+ * An entry that is 'busy' is being used by a search in progress
+ * and must not be replaced.
+ */
+#define RXL_CACHE_SIZE 4
+static struct rxl_cache {
+	char *patn;
+	int nocase;
+	int busy;
+	unsigned short *rxl;
+} rxl_cache[RXL_CACHE_SIZE];
+static int rxl_cache_next;
+
+static unsigned short *rxl_get(const char *patn safe, int nocase,
+			       int *slotp safe)
+{
+	unsigned short *rxl;
+	int i, tries;
+
+	for (i = 0; i < RXL_CACHE_SIZE; i++) {
+		struct rxl_cache *c = &rxl_cache[i];
+
+		if (c->patn && c->nocase == nocase &&
+		    strcmp(c->patn, patn) == 0) {
+			c->busy += 1;
+			*slotp = i;
+			return c->rxl;
+		}
+	}
+	*slotp = -1;
+	rxl = rxl_parse(patn, NULL, nocase);
+	if (!rxl)
+		return NULL;
+	for (tries = 0; tries < RXL_CACHE_SIZE; tries++) {
+		struct rxl_cache *c;
+
+		i = rxl_cache_next;
+		rxl_cache_next = (i + 1) % RXL_CACHE_SIZE;
+		c = &rxl_cache[i];
+		if (c->busy)
+			continue;
+		free(c->patn);
+		free(c->rxl);
+		c->patn = strdup(patn);
+		c->nocase = nocase;
+		c->rxl = rxl;
+		c->busy = 1;
+		*slotp = i;
+		break;
+	}
+	return rxl;
+}
+
+static void rxl_put(unsigned short *rxl safe, int slot)
+{
+	if (slot < 0)
+		free(rxl);
+	else
+		rxl_cache[slot].busy -= 1;
+}
+
 DEF_CMD(text_search)
 {
 	struct mark *m, *endmark = NULL;
 	unsigned short *rxl;
 	int since_start;
 	int ret;
+	int slot;
 
 	if (!ci->str)
 		return Enoarg;
 
-	rxl = rxl_parse(ci->str, NULL, ci->num);
+	rxl = rxl_get(ci->str, ci->num, &slot);
 	if (!rxl)
 		return Einval;
 
@@ -271,8 +334,10 @@ DEF_CMD(text_search)
 		m = ci->mark;
 		endmark = mark_dup(m);
 		point = call_ret(mark, "doc:point", ci->focus);
-		if (!endmark)
+		if (!endmark) {
+			rxl_put(rxl, slot);
 			return Efail;
+		}
 		if (strcmp(ci->key, "text-match") == 0)
 			since_start = search_forward(ci->focus, m, ci->mark2,
 						     point, rxl, endmark, True);
@@ -334,7 +399,7 @@ DEF_CMD(text_search)
 	} else {
 		ret = Einval;
 	}
-	free(rxl);
+	rxl_put(rxl, slot);
 	return ret;
 }
 
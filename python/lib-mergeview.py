@@ -12,11 +12,21 @@
 # If cursor is not on any, it is moved forward to the next one.
 #
 
+# "text-search" patterns for the marker lines.  "?4:" makes the four
+# characters match literally.
+start_ptn = "^(?4:<<<<)"
+orig_end_ptn = "^(?4:||||)"
+before_end_ptn = "^(?4:====)"
+end_ptn = "^(?4:>>>>)"
+start_or_end_ptn = "^(<<<<|>>>>)"
+
 class MergePane(edlib.Pane):
     def __init__(self, focus):
         edlib.Pane.__init__(self, focus)
         self.marks = None
         self.conflicts = 0
+        self.marker_attr = None
+        self.sig = None
         self.call("doc:request:doc:replaced")
 
     def fore(self, m, end, ptn):
@@ -24,103 +34,132 @@ class MergePane(edlib.Pane):
             return None
         m = m.dup()
         try:
-            if self.call("text-search", m, end, "^(?4:"+ptn+")") > 1:
+            if self.call("text-search", m, end, ptn) > 1:
                 self.call("doc:EOL", -1, m)
                 return m
         except edlib.commandfailed:
             pass
         return None
 
-    def mark(self, start, end):
-        # There is probably a 3-way merge between start and end
-
+    def clear(self):
+        # Remove any highlight from the current merge
         if self.marks:
             self.call("doc:set-attr", "render:merge-same",
                       self.marks[0], self.marks[3])
             self.marks = None
-        start = self.fore(start, end, "<<<<")
-        m1 = self.fore(start, end, "||||")
-        m2 = self.fore(m1, end, "====")
-        m3 = self.fore(m2, end, ">>>>")
+            self.sig = None
+
+    def signature(self, start, m1, m2, m3):
+        # Identifies the content of the three sections and the ">>>>"
+        # line, so an unchanged merge need not be diffed again.
+        call = self.call
+        e = m3.dup()
+        call("doc:EOL", 1, e, 1)
+        return hash((call("doc:get-str", start, m1, ret='str'),
+                     call("doc:get-str", m1, m2, ret='str'),
+                     call("doc:get-str", m2, m3, ret='str'),
+                     call("doc:get-str", m3, e, ret='str')))
+
+    def mark(self, start, end):
+        # There is probably a 3-way merge between start and end
+
+        self.clear()
+        call = self.call
+        start = self.fore(start, end, start_ptn)
+        m1 = self.fore(start, end, orig_end_ptn)
+        m2 = self.fore(m1, end, before_end_ptn)
+        m3 = self.fore(m2, end, end_ptn)
         if not m3:
             # something wasn't found, give up
             return
 
-        cmd = self.call("MakeWiggle", ret='comm')
+        cmd = call("MakeWiggle", ret='comm')
         t = start.dup()
-        self.call("doc:EOL", 1, t, 1)
+        call("doc:EOL", 1, t, 1)
         cmd("orig", self, t, m1)
 
         t = m1.dup()
-        self.call("doc:EOL", 1, t, 1)
+        call("doc:EOL", 1, t, 1)
         cmd("before", self, t, m2)
 
         t = m2.dup()
-        self.call("doc:EOL", 1, t, 1)
+        call("doc:EOL", 1, t, 1)
         cmd("after", self, t, m3)
 
         ret = cmd("set-wiggle", self, "render:merge-same")
         del cmd
 
         self.marks = [start, m1, m2, m3]
+        self.sig = self.signature(start, m1, m2, m3)
         self.conflicts = ret - 1
-        self.call("view:changed", start, m3)
+        if self.conflicts:
+            self.marker_attr = "fg:red-40"
+        else:
+            self.marker_attr = "fg:green-40"
+        call("view:changed", start, m3)
         return 1
 
     def handle_alt_m(self, key, focus, mark, **a):
         "handle:K:A-m"
 
-        if self.marks:
-            focus.call("doc:set-attr", "render:merge-same",
-                       self.marks[0], self.marks[3])
-            self.marks = None
-
         if not mark:
+            self.clear()
             return
+        call = focus.call
         m = mark.dup()
-        focus.call("doc:EOL", -1, m)
+        call("doc:EOL", -1, m)
         try:
-            focus.call("text-search", m, "^(<<<<|>>>>)")
-            focus.call("doc:EOL", -1, m)
+            call("text-search", m, start_or_end_ptn)
+            call("doc:EOL", -1, m)
         except edlib.commandfailed:
+            self.clear()
             self.call("Message:modal", "Cannot find a merge mark")
             return edlib.Efalse
-        if focus.call("text-match", m.dup(), ">>>>") > 1:
+        if call("text-match", m.dup(), ">>>>") > 1:
             # was inside a merge, move to start
             try:
                 # search backwards
-                focus.call("text-search", m, 0,1, "^<<<<")
+                call("text-search", m, 0,1, start_ptn)
             except edlib.commandfailed:
                 # weird, no start,  I guess we give up
+                self.clear()
                 self.call("Message:modal", "Cannot find a merge mark")
                 return edlib.Efalse
-            focus.call("doc:EOL", -1, m)
+            call("doc:EOL", -1, m)
         # must be at the start.
         try:
             end = m.dup()
-            focus.call("doc:EOL", 1, end)
-            focus.call("text-search", end, "^(<<<<|>>>>)")
-            focus.call("doc:EOL", -1, end)
+            call("doc:EOL", 1, end)
+            call("text-search", end, start_or_end_ptn)
+            call("doc:EOL", -1, end)
         except edlib.commandfailed:
             # There is no end
+            self.clear()
             return edlib.Efalse
         if focus.following(end) != '>':
             # didn't find a matching end.
+            self.clear()
             mark.to_mark(end)
             self.call("Message:modal", "Merge wasn't terminated, next is here")
             return edlib.Efalse
 
-        m1 = self.fore(m, end, "||||")
-        m2 = self.fore(m1, end, "====")
-        m3 = end
-        if m3:
-            self.call("doc:EOL", 1, m3, 1)
-            self.mark(m, m3)
-            mark.to_mark(m3)
+        if self.marks and m == self.marks[0] and end == self.marks[3]:
+            # This merge is already highlighted and remark() keeps
+            # that current, so don't clear and re-wiggle it.
+            self.call("doc:EOL", 1, end, 1)
+            mark.to_mark(end)
+            return 1
+
+        self.call("doc:EOL", 1, end, 1)
+        self.mark(m, end)
+        mark.to_mark(end)
         return 1
 
     def remark(self, key, **a):
         if self.marks:
+            if self.signature(*self.marks) == self.sig:
+                # Nothing that the diff looks at has changed
+                return edlib.Efalse
             m = self.marks[3].dup()
             self.call("doc:EOL", 1, m, 1)
             self.mark(self.marks[0], m)
@@ -151,13 +190,12 @@ class MergePane(edlib.Pane):
         o,b,a,e = self.marks
 
         if str == "start-of-line":
+            # Most lines are outside the merge, so rule those
+            # out before testing against each marker line.
+            if mark < o or mark > e:
+                return edlib.Efallthrough
             if mark == o or mark == b or mark == a or mark == e:
-                if self.conflicts:
-                    comm2("attr:cb", focus, mark, "fg:red-40",
-                          0, 102)
-                else:
-                    comm2("attr:cb", focus, mark, "fg:green-40",
-                          0, 102)
+                comm2("attr:cb", focus, mark, self.marker_attr, 0, 102)
             return edlib.Efallthrough
 
         if str == "render:merge-same":
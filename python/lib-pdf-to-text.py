@@ -5,26 +5,70 @@
 # The pdf-to-text function extracts text from the given child,
 # converts it from pdf to text, and creates a text doc with the
 # text.
+# If the pypdfium2 module is available the text is extracted
+# in-process, otherwise pdftotext is run.
+#
+# The document is complete before it is returned.  doc-email adds it to
+# a multipart document, and that doesn't pass changes in a part on to
+# its own viewers, so text added later would never be shown.
 
 import subprocess
 
+def pdftotext(pdf):
+    try:
+        p = subprocess.Popen(["/usr/bin/pdftotext", "-layout", "-", "-"],
+                             close_fds=True,
+                             stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                             stdin =subprocess.PIPE)
+    except OSError as e:
+        return "PDF conversion failed\n%s\n" % e
+    out, err = p.communicate(pdf)
+    err = err.decode("utf-8", 'ignore')
+    if err:
+        edlib.LOG("pdftotext:", err)
+    if not out:
+        return "PDF conversion failed\n" + err
+    return out.decode("utf-8", 'ignore')
+
+def pdfium_text(content):
+    try:
+        import pypdfium2
+    except ImportError:
+        return None
+    try:
+        pdf = pypdfium2.PdfDocument(content)
+    except Exception:
+        # Let pdftotext try, and report the problem.
+        return None
+    pages = []
+    i = 0
+    try:
+        for i in range(len(pdf)):
+            page = pdf[i]
+            try:
+                tp = page.get_textpage()
+                txt = tp.get_text_range()
+                tp.close()
+            finally:
+                page.close()
+            # Separate pages with form-feed, as pdftotext does.
+            txt = txt.replace('\r\n', '\n').rstrip('\n')
+            pages.append(txt + '\n\f')
+    except Exception as e:
+        # A damaged page - let pdftotext try the whole document.
+        edlib.LOG("pdf-to-text: page %d:" % (i + 1), e)
+        return None
+    finally:
+        pdf.close()
+    return ''.join(pages)
+
 def pdf_to_text(key, home, focus, comm2, **a):
     pdf = focus.call("doc:get-bytes", ret='bytes')
 
-    p = subprocess.Popen(["/usr/bin/pdftotext", "-layout", "-", "-"], close_fds=True,
-                         stdout=subprocess.PIPE, stderr = subprocess.PIPE,
-                         stdin =subprocess.PIPE)
-    out,err = p.communicate(pdf)
-    if err:
-        edlib.LOG("pdftotext:", err.decode("utf-8"))
-
-    if out:
-        doc = focus.call("doc:from-text", "pdf-document", out.decode("utf-8"),
-                         ret='pane')
-    else:
-        doc = focus.call("doc:from-text", "pdf-document",
-                         "PDF conversion failed\n" + err.decode(),
-                         ret='pane')
+    txt = pdfium_text(pdf)
+    if txt is None:
+        txt = pdftotext(pdf)
+    doc = focus.call("doc:from-text", "pdf-document", txt, ret='pane')
     comm2("cb", doc)
     return 1
 
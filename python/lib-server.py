@@ -4,18 +4,40 @@
 # May be distributed under terms of GPLv2 - see file:COPYING
 #
 
-import socket, os, sys, fcntl, signal
+import socket, os, sys, signal, struct
 
 if 'EDLIB_SOCK' in os.environ:
     sockpath = os.environ['EDLIB_SOCK']
 else:
     sockpath = "/tmp/edlib-neilb"
 
-try:
+# A name starting '@' is in the Linux abstract namespace.  Nothing is
+# created in the filesystem so there is nothing to unlink, but nor is
+# there any file permission limiting who can connect, so the server
+# checks the uid of each client instead.
+abstract = sockpath.startswith('@')
+if abstract:
+    sockaddr = '\0' + sockpath[1:]
+else:
+    sockaddr = sockpath
+
+# SOCK_SEQPACKET keeps message boundaries, so each send() arrives as
+# exactly one recv().  A message can hold a full path name.
+msgsize = 8192
+
+# When run by edlib, "editor" is provided.  Otherwise this is the client.
+is_client = "editor" not in globals()
+
+if not is_client:
     class ServerPane(edlib.Pane):
         # This pane received requests on a socket and
         # forwards them to the editor.  When a notification
         # arrives, it is sent back to the client
+
+        # Panes with a client waiting for self.doc to be done, as a
+        # dict so they are kept in the order they started waiting.
+        waiting = {}
+
         def __init__(self, sock):
             edlib.Pane.__init__(self, editor)
             self.sock = sock
@@ -23,123 +45,187 @@ try:
             self.disp = None
             self.doc = None
             self.want_close = False
+            # Set by display_callback()
+            self.destpane = None
+            self.display_time = 0
+            # recv() into the same buffer each time rather than
+            # allocating a new one.
+            self.buf = bytearray(msgsize)
+            self.bufview = memoryview(self.buf)
+            sock.setblocking(False)
             editor.call("event:read", sock.fileno(),
                         self.read)
 
+        def reply(self, msg):
+            self.sock.send(msg)
+
         def read(self, key, **a):
-            if self.sock:
-                msg = self.sock.recv(1000)
+            # Called when the socket is readable.  Handle every message
+            # the client has sent so far on this one wakeup.  The event
+            # stays registered, so there is nothing to re-arm; the next
+            # call comes when more arrives.
+            eof = not self.sock
+            if not eof:
+                recvmsg_into = self.sock.recvmsg_into
+                bufs = [self.buf]
+            while not eof:
+                try:
+                    n, anc, flags, addr = recvmsg_into(bufs)
+                except BlockingIOError:
+                    break
+                if not n:
+                    eof = True
+                    break
+                if flags & socket.MSG_TRUNC:
+                    # Didn't fit in the buffer, so the rest is lost.
+                    self.reply(b"Message too long")
+                    continue
+                self.command(bytes(self.bufview[:n]))
+                if not self.sock:
+                    # "Close" was received
+                    return edlib.Efalse
+            if eof:
+                self.teardown()
+                return edlib.Efalse
+            return 1
+
+        def teardown(self):
+            # The client has gone, or is going, so there is no one to
+            # tell.  handle_close() closes the socket and display.
+            self.want_close = False
+            self.close()
+
+        def command(self, msg):
+            cmd = None
+            if msg:
+                cmd = self.commands.get(msg[0])
+            if cmd is None:
+                self.reply(b"Unknown")
+                return 1
+            prefix, has_arg, handler = cmd
+            if has_arg:
+                ok = msg.startswith(prefix)
             else:
-                msg = None
+                ok = msg == prefix
+            if not ok:
+                self.reply(b"Unknown")
+                return 1
+            return handler(self, msg[len(prefix):])
 
-            if not msg :
-                if self.disp:
-                    self.disp.close()
-                if self.sock:
-                    self.sock.close()
-                self.sock = None
-                self.close()
-                return edlib.Efalse
+        def do_open(self, arg):
+            path = arg.decode("utf-8")
+            try:
+                # 8==reload
+                d = editor.call("doc:open", -1, 8, path, ret='pane')
+            except edlib.commandfailed:
+                d = None
+            if not d:
+                self.reply(b"FAIL")
+                return 1
+            if self.term:
+                d.call("doc:attach-view", self.term, 1,
+                       ret='pane')
+                self.term.take_focus()
+                self.reply(b"OK")
+                return 1
+            self.display_time = 0
+            self.destpane = None
+            self.call("editor:notify:all-displays", self.display_callback)
+            if self.destpane:
+                p = self.destpane.leaf
+                self.destpane = None
+                # Need to avoid transient popups
+                if p:
+                    p = p.call("ThisPane", ret='pane')
+                if p:
+                    p2 = p.call("PopupTile", "MD3tsa", ret='pane')
+                    if p2:
+                        p = p2
+                if p:
+                    d.call("doc:attach-view", p, 1, ret='pane')
+                    p.take_focus()
+                    self.reply(b"OK")
+                else:
+                    self.reply(b"No Cannot create pane")
             else:
-                if msg[:5] == b"open:":
-                    path = msg[5:].decode("utf-8")
-                    try:
-                        # 8==reload
-                        d = editor.call("doc:open", -1, 8, path, ret='pane')
-                    except edlib.commandfailed:
-                        d = None
-                    if not d:
-                        self.sock.send(b"FAIL")
-                        return 1
-                    if self.term:
-                        d.call("doc:attach-view", self.term, 1,
-                               ret='pane')
-                        self.term.take_focus()
-                        self.sock.send(b"OK")
-                        return 1
-                    self.display_time = 0
-                    self.destpane = None
-                    self.call("editor:notify:all-displays", self.display_callback)
-                    if self.destpane:
-                        p = self.destpane.leaf
-                        self.destpane = None
-                        # Need to avoid transient popups
-                        if p:
-                            p = p.call("ThisPane", ret='pane')
-                        if p:
-                            p2 = p.call("PopupTile", "MD3tsa", ret='pane')
-                            if p2:
-                                p = p2
-                        if p:
-                            d.call("doc:attach-view", p, 1, ret='pane')
-                            p.take_focus()
-                            self.sock.send(b"OK")
-                        else:
-                            self.sock.send(b"No Cannot create pane")
-                    else:
-                        self.sock.send(b"No Display!")
-                    return 1
-                if msg[:21] == b"doc:request:doc:done:":
-                    path = msg[21:].decode("utf-8")
-                    d = editor.call("doc:open", -1, path, ret='pane')
-                    if not d:
-                        self.sock.send(b"FAIL")
-                        return 1
-                    self.add_notify(d, "doc:done")
-                    self.add_notify(d, "Notify:Close")
-                    self.doc = d
-                    if self.term:
-                        self.term.call("Display:set-noclose",
-                                       "Cannot close display until document done - use 'C-x #'")
-                    self.sock.send(b"OK")
-                    return 1
-                if msg == b"Request:Notify:Close":
-                    if self.term:
-                        # trigger finding a new document
-                        self.term.call("Window:bury")
-                    self.want_close = True
-                    self.sock.send(b"OK")
-                    return 1
-                if msg.startswith(b"term "):
-                    w = msg.split(b' ')
-                    path = w[1].decode("utf-8")
-                    p = editor
-
-                    env={}
-                    for v in w[2:]:
-                        vw = v.split(b'=')
-                        if len(vw) == 2 and vw[0] in [b'TERM',
-                                                      b'DISPLAY',
-                                                      b'REMOTE_SESSION']:
-                            env[vw[0].decode("utf-8")] = vw[1].decode("utf-8")
-
-                    p = p.call("attach-display-ncurses", path, env['TERM'],
-                               ret='pane')
-                    for v in env:
-                        p[v] = env[v]
-                    self.disp = p
-                    self.term = self.disp.call("editor:activate-display", ret='pane')
-                    self.add_notify(self.disp, "Notify:Close")
-                    self.sock.send(b"OK")
-                    return 1
-                if msg == b"Sig:Winch":
-                    if self.term:
-                        self.term.call("Sig:Winch")
-                        self.sock.send(b"OK")
-                    else:
-                        self.sock.send(b"Unknown")
-                    return 1
-                if msg == b"Close":
-                    if self.disp:
-                        self.disp.call("Display:set-noclose")
-                        self.disp.call("Display:close")
-                        self.disp = None
-                    self.sock.close()
-                    self.sock = None
-                    self.close()
-                    return edlib.Efalse
-                self.sock.send(b"Unknown")
+                self.reply(b"No Display!")
+            return 1
+
+        def do_request_done(self, arg):
+            path = arg.decode("utf-8")
+            try:
+                d = editor.call("doc:open", -1, path, ret='pane')
+            except edlib.commandfailed:
+                d = None
+            if not d:
+                self.reply(b"FAIL")
                 return 1
+            self.add_notify(d, "doc:done")
+            self.add_notify(d, "Notify:Close")
+            self.doc = d
+            ServerPane.waiting[self] = None
+            if self.term:
+                self.term.call("Display:set-noclose",
+                               "Cannot close display until document done - use 'C-x #'")
+            self.reply(b"OK")
+            return 1
+
+        def do_request_close(self, arg):
+            if self.term:
+                # trigger finding a new document
+                self.term.call("Window:bury")
+            self.want_close = True
+            self.reply(b"OK")
+            return 1
+
+        def do_term(self, arg):
+            w = arg.decode("utf-8").split(' ')
+            path = w[0]
+            env={}
+            for v in w[1:]:
+                vw = v.split('=')
+                if len(vw) == 2 and vw[0] in ['TERM',
+                                              'DISPLAY',
+                                              'REMOTE_SESSION']:
+                    env[vw[0]] = vw[1]
+
+            p = editor.call("attach-display-ncurses", path, env['TERM'],
+                            ret='pane')
+            for v in env:
+                p[v] = env[v]
+            self.disp = p
+            self.term = self.disp.call("editor:activate-display", ret='pane')
+            self.add_notify(self.disp, "Notify:Close")
+            self.reply(b"OK")
+            return 1
+
+        def do_winch(self, arg):
+            if self.term:
+                self.term.call("Sig:Winch")
+                self.reply(b"OK")
+            else:
+                self.reply(b"Unknown")
+            return 1
+
+        def do_close(self, arg):
+            if self.disp:
+                self.disp.call("Display:set-noclose")
+                self.disp.call("Display:close")
+                self.disp = None
+            self.teardown()
+            return edlib.Efalse
+
+        # Each command starts with a different byte, so that byte
+        # finds the only command that might match.
+        # (prefix, takes an argument, handler)
+        commands = {
+            ord('o'): (b"open:", True, do_open),
+            ord('d'): (b"doc:request:doc:done:", True, do_request_done),
+            ord('R'): (b"Request:Notify:Close", False, do_request_close),
+            ord('t'): (b"term ", True, do_term),
+            ord('S'): (b"Sig:Winch", False, do_winch),
+            ord('C'): (b"Close", False, do_close),
+        }
 
         def handle_term_close(self, key, focus, **a):
             "handle:Notify:Close"
@@ -147,22 +233,24 @@ try:
                 self.disp = None
                 self.term = None
                 if self.want_close:
-                    self.sock.send(b"Close")
+                    self.reply(b"Close")
                     self.want_close = False
             if focus == self.doc:
                 # same as doc:done
                 self.doc = None
+                ServerPane.waiting.pop(self, None)
                 if self.term:
                     self.term.call("Window:set-noclose")
-                self.sock.send(b"Done")
+                self.reply(b"Done")
             return 1
 
         def handle_done(self, key, str, **a):
             "handle:doc:done"
             if str != "test":
+                ServerPane.waiting.pop(self, None)
                 if self.term:
                     self.term.call("Window:set-noclose")
-                self.sock.send(b"Done")
+                self.reply(b"Done")
             return 1
 
         def display_callback(self, key, focus, num, **a):
@@ -173,19 +261,16 @@ try:
 
         def handle_close(self, key, **a):
             "handle:Close"
+            ServerPane.waiting.pop(self, None)
             if self.sock:
                 if self.want_close:
-                    self.sock.send(b"Close")
+                    self.reply(b"Close")
                 self.sock.close()
                 self.sock = None
             if self.disp:
                 self.disp.close()
                 self.disp = None
 
-    is_client = False
-except:
-    is_client = True
-
 if is_client:
     term = False
     file = None
@@ -201,26 +286,40 @@ if is_client:
         print("edlibclient: must provide -t or filename (or both)")
         sys.exit(1)
 
-    s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    s = socket.socket(socket.AF_UNIX, socket.SOCK_SEQPACKET)
     try:
-        s.connect(sockpath)
+        s.connect(sockaddr)
     except OSError:
         print("Cannot connect to ",sockpath)
         sys.exit(1)
 
     winch_ok = False
+    # A resize sends many SIGWINCH.  Only one Sig:Winch is sent at a
+    # time; any that arrive before it is answered cause one more to be
+    # sent after.
+    winch_sent = False
+    winch_again = False
+
+    def send_winch():
+        global winch_sent
+        winch_sent = True
+        s.send(b"Sig:Winch")
 
     if term:
         t = os.ttyname(0)
         if t:
-            m = ["term", t]
-            for i in ['TERM','DISPLAY']:
-                if i in os.environ:
-                    m.append(i + "=" + os.environ[i])
-            if 'SSH_CONNECTION' in os.environ:
-                m.append("REMOTE_SESSION=yes")
-
-            s.send(' '.join(m).encode('utf-8'))
+            # Build the message from bytes: environb holds the
+            # environment as it arrived, before any decoding.
+            m = [b"term", os.fsencode(t)]
+            env = os.environb
+            for i in [b'TERM', b'DISPLAY']:
+                v = env.get(i)
+                if v is not None:
+                    m.append(i + b"=" + v)
+            if b'SSH_CONNECTION' in env:
+                m.append(b"REMOTE_SESSION=yes")
+
+            s.send(b' '.join(m))
             ret = s.recv(100)
             if ret != b"OK":
                 print("Cannot open terminal on", t)
@@ -228,21 +327,28 @@ if is_client:
                 s.recv(100)
                 sys.exit(1)
             def handle_winch(sig, frame):
-                if winch_ok:
-                    s.send(b"Sig:Winch")
+                global winch_again
+                if winch_sent:
+                    winch_again = True
+                elif winch_ok:
+                    send_winch()
                 return 1
             signal.signal(signal.SIGWINCH, handle_winch)
 
     if file:
-        file = os.path.realpath(file)
-        s.send(b"open:" + file.encode("utf-8"))
+        path = os.path.abspath(file).encode("utf-8")
+        # Send both requests before waiting for either reply.
+        s.send(b"open:" + path)
+        s.send(b"doc:request:doc:done:" + path)
         ret = s.recv(100)
         if ret != b"OK":
+            # The doc:request was sent too, and its reply must be
+            # collected before the "Close" reply.
+            s.recv(100)
             s.send(b"Close")
             s.recv(100)
             print("Cannot open: ", ret.decode("utf-8"))
             sys.exit(1)
-        s.send(b"doc:request:doc:done:"+file.encode("utf-8"))
     else:
         s.send(b"Request:Notify:Close")
     ret = s.recv(100)
@@ -252,11 +358,20 @@ if is_client:
         s.recv(100)
         sys.exit(1)
     winch_ok = True
+    # This wait can last as long as the editing session, so receive
+    # each reply into the same buffer.
+    buf = bytearray(100)
+    view = memoryview(buf)
     while True:
-        ret = s.recv(100)
-        if ret != b"OK":
+        n = s.recv_into(buf)
+        if view[:n] != b"OK":
+            ret = bytes(view[:n])
             break
         # probably a reply to Sig:Winch
+        winch_sent = False
+        if winch_again:
+            winch_again = False
+            send_winch()
     winch_ok = False
     if ret != b"Done" and ret != b"Close":
         print("Received unexpected notification: ", ret.decode('utf-8'))
@@ -275,38 +390,41 @@ else:
         global server_sock
         try:
             (new, addr) = server_sock.accept()
-            ServerPane(new)
-        except:
-            pass
+        except BlockingIOError:
+            # Another wakeup already took it
+            return 1
+        except OSError as e:
+            edlib.LOG("lib-server: accept failed:", e)
+            return 1
+        if abstract:
+            cred = new.getsockopt(socket.SOL_SOCKET, socket.SO_PEERCRED,
+                                  struct.calcsize("iII"))
+            pid, uid, gid = struct.unpack("iII", cred)
+            if uid != os.getuid():
+                new.close()
+                return 1
+        ServerPane(new)
+        return 1
 
     def server_done(key, focus, **a):
         ret = focus.call("doc:notify:doc:done", "test")
         if ret > 0:
             # maybe save, then notify properly
-            fn = focus["filename"]
-            mod = focus["doc-modified"]
-            if fn and mod == "yes":
+            # Only a doc with a file needs to be saved first
+            if focus["filename"] and focus["doc-modified"] == "yes":
                 focus.call("Message", "Please save first!")
             else:
                 focus.call("doc:notify:doc:done")
                 # FIXME need something better than 'bury'
                 # If it was already visible, it should stay that way
                 focus.call("Window:bury")
-        else:
-            # Find and visit a doc waiting to be done
-            choice = []
-            def chose(choice, a):
-                focus = a['focus']
-                if focus.notify("doc:done", "test") > 0:
-                    choice.append(focus)
-                    return 1
-                return 0
-            focus.call("docs:byeach", lambda key,**a:chose(choice, a))
-            if len(choice):
-                par = focus.call("ThisPane", ret='pane')
-                if par:
-                    par = choice[0].call("doc:attach-view", par, 1, ret='pane')
-                    par.take_focus()
+        elif ServerPane.waiting:
+            # Visit the doc that has been waiting longest to be done
+            d = next(iter(ServerPane.waiting)).doc
+            par = focus.call("ThisPane", ret='pane')
+            if par:
+                par = d.call("doc:attach-view", par, 1, ret='pane')
+                par.take_focus()
 
         return 1
 
@@ -318,19 +436,20 @@ else:
             focus.call("event:free", server_accept)
             server_sock.close()
             server_sock = None
-        try:
-            os.unlink(sockpath)
-        except OSError:
-            pass
-        mask = os.umask(0o077)
-        s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
-        s.bind(sockpath)
-        os.umask(mask)
+        s = socket.socket(socket.AF_UNIX,
+                          socket.SOCK_SEQPACKET | socket.SOCK_NONBLOCK)
+        if abstract:
+            s.bind(sockaddr)
+        else:
+            try:
+                os.unlink(sockpath)
+            except OSError:
+                pass
+            mask = os.umask(0o077)
+            s.bind(sockpath)
+            os.umask(mask)
         s.listen(5)
 
-        fl = fcntl.fcntl(s.fileno(), fcntl.F_GETFL)
-        fcntl.fcntl(s.fileno(), fcntl.F_SETFL, fl | os.O_NONBLOCK)
-
         focus.call("event:read", s.fileno(), server_accept)
         server_sock = s
         if key != "key":
@@ -3,12 +3,41 @@
 # May be distributed under terms of GPLv2 - see file:COPYING
 #
 
-import subprocess, os, fcntl, signal
+import subprocess, os, fcntl, signal, codecs
 
 class ShellPane(edlib.Pane):
+    # These are class attributes rather than module globals, as every
+    # python module is loaded into the same namespace.
+
+    # Read as much as a default pipe can hold, so a burst of output is
+    # collected in one read.
+    readsize = 65536
+    # Output is added to the doc once this much has arrived, or after
+    # flush_msecs if less has.
+    flush_size = 65536
+    flush_msecs = 16
+    # When testing, use blocking IO and add output immediately, for
+    # predictable results.
+    testing = 'EDLIB_TESTING' in os.environ
+    # How often to check whether the command has exited once its output
+    # has closed.
+    exit_msecs = 50
+    # Most output to read in one wakeup before letting other events run.
+    drain_max = 16 * readsize
+    # edlib never changes its own environment, so copy it just once.
+    base_env = os.environ.copy()
+
     def __init__(self, focus, reusable):
         edlib.Pane.__init__(self, focus)
-        self.line = b''
+        self.pending = bytearray()
+        # Read into the same buffer each time rather than allocating
+        # a new one.
+        self.buf = bytearray(self.readsize)
+        self.bufview = memoryview(self.buf)
+        self.flush_queued = False
+        # Output that isn't valid utf-8 shouldn't stop the command
+        # being shown.
+        self.decoder = codecs.getincrementaldecoder("utf-8")('replace')
         self.pipe = None
         self.call("doc:request:Abort")
         if reusable:
@@ -42,8 +71,10 @@ class ShellPane(edlib.Pane):
             return edlib.Efail
         if header:
             self.call("doc:replace", "Cmd: %s\nCwd: %s\n\n" % (cmd,cwd))
-        env = os.environ.copy()
-        env['PWD'] = cwd
+        if self.base_env.get('PWD') == cwd:
+            env = self.base_env
+        else:
+            env = dict(self.base_env, PWD=cwd)
         try:
             self.pipe = subprocess.Popen(cmd, shell=True, close_fds=True,
                                          cwd=cwd, env=env,
@@ -58,8 +89,7 @@ class ShellPane(edlib.Pane):
         self.call("doc:set:doc-status", "Running")
         self.call("doc:notify:doc:status-changed")
         fd = self.pipe.stdout.fileno()
-        if 'EDLIB_TESTING' not in os.environ:
-            # when testing, use blocking IO for predictable results
+        if not self.testing:
             fl = fcntl.fcntl(fd, fcntl.F_GETFL)
             fcntl.fcntl(fd, fcntl.F_SETFL, fl | os.O_NONBLOCK)
         self.call("event:read", fd, self.read)
@@ -68,34 +98,81 @@ class ShellPane(edlib.Pane):
     def read(self, key, **a):
         if not self.pipe:
             return edlib.Efalse
-        try:
-            r = os.read(self.pipe.stdout.fileno(), 4096)
-        except IOError:
-            return 1
-        if r is None or len(r) == 0:
-            (out,err) = self.pipe.communicate()
-            ret = self.pipe.poll()
-            self.pipe = None
-            l = self.line + out
-            self.line = b''
-            self.call("doc:replace", l.decode("utf-8"))
-            if not ret:
-                self.call("doc:replace", "\nProcess Finished\n")
-            elif ret > 0:
-                self.call("doc:replace", "\nProcess Finished (%d)\n" % ret)
+        fd = self.pipe.stdout.fileno()
+        got = 0
+        eof = False
+        # Take everything available now so a fast producer costs one
+        # wakeup per burst rather than one per read, but don't let an
+        # endless producer keep the editor from other work.
+        while got < self.drain_max:
+            try:
+                n = os.readv(fd, [self.buf])
+            except IOError:
+                break
+            if n == 0:
+                eof = True
+                break
+            self.pending += self.bufview[:n]
+            got += n
+            if self.testing:
+                break
+        if eof:
+            l = self.pending
+            self.pending = bytearray()
+            self.call("doc:replace", self.decoder.decode(l, True))
+            # The command may not have exited yet, and waiting for it
+            # here would block the editor.
+            if self.testing:
+                self.pipe.wait()
+            if self.pipe.poll() is None:
+                self.call("event:timer", self.exit_msecs, self.check_exit)
             else:
-                self.call("doc:replace", "\nProcess Finished (signaled %d)\n" % -ret)
-            self.call("doc:set:doc-status", "Complete")
-            self.call("doc:notify:doc:status-changed")
+                self.finished()
             return edlib.Efalse
-        l = self.line + r
-        i = l.rfind(b'\n')
-        if i >= 0:
-            self.call("doc:replace", l[:i+1].decode("utf-8"))
-            l = l[i+1:]
-        self.line = l
+        if not got:
+            return 1
+        if self.testing or len(self.pending) >= self.flush_size:
+            self.flush()
+        elif not self.flush_queued:
+            self.flush_queued = True
+            self.call("event:timer", self.flush_msecs, self.flush_timer)
         return 1
 
+    def check_exit(self, key, **a):
+        if not self.pipe:
+            return edlib.Efalse
+        if self.pipe.poll() is None:
+            return 1
+        self.finished()
+        return edlib.Efalse
+
+    def finished(self):
+        ret = self.pipe.returncode
+        self.pipe.stdout.close()
+        self.pipe = None
+        if not ret:
+            self.call("doc:replace", "\nProcess Finished\n")
+        elif ret > 0:
+            self.call("doc:replace", "\nProcess Finished (%d)\n" % ret)
+        else:
+            self.call("doc:replace", "\nProcess Finished (signaled %d)\n" % -ret)
+        self.call("doc:set:doc-status", "Complete")
+        self.call("doc:notify:doc:status-changed")
+
+    def flush(self):
+        # Only complete lines are added; a partial line waits for
+        # the rest.
+        i = self.pending.rfind(b'\n')
+        if i >= 0:
+            self.call("doc:replace", self.decoder.decode(self.pending[:i+1]))
+            del self.pending[:i+1]
+
+    def flush_timer(self, key, **a):
+        self.flush_queued = False
+        if self.pipe:
+            self.flush()
+        return edlib.Efalse
+
     def handle_close(self, key, **a):
         "handle:Close"
         if self.pipe is not None:
@@ -114,6 +191,7 @@ class ShellPane(edlib.Pane):
 
         if self.pipe is not None:
             os.killpg(self.pipe.pid, signal.SIGTERM)
+            self.flush()
             self.call("doc:replace", "\nProcess signalled\n")
         return 1
 
@@ -24,24 +24,13 @@
 # characters.
 
 
-import re
-
 def span(line, chars):
-    s = ''
-    for c in line:
-        if c in chars:
-            s += c
-        else:
-            break
-    return s
+    # The leading part of 'line' made only of characters in 'chars'
+    return line[:len(line) - len(line.lstrip(chars))]
 
 def textwidth(line):
-    w = 0
-    for c in line:
-        if c == '\t':
-            w = w | 7
-        w += 1
-    return w
+    # Tabs advance to the next multiple of 8
+    return len(line.expandtabs(8))
 
 
 def do_replace(focus, start, end, new, strip):
@@ -53,35 +42,48 @@ def do_replace(focus, start, end, new, strip):
     # If we get confused, just do a wholesale replacement of the
     # remainder.
 
+    # The current text is fetched once and compared in python; 'start'
+    # is only moved when there is an edit to make.
+    old = focus.call("doc:get-str", start, end, ret='str')
+    o = 0
+    n = 0
+    skip = 0
     second = 0
-    while start < end and new:
-        c = focus.following(start)
-        if c == new[0]:
+    while o < len(old) and n < len(new):
+        c = old[o]
+        if c == new[n]:
             # a match, just skip it
-            new = new[1:]
-            focus.next(start)
+            o += 1
+            n += 1
+            skip += 1
             continue
+        if skip:
+            focus.call("doc:char", start, skip)
+            skip = 0
         if c in ' \t\n' or c in strip:
             # maybe this got removed
             s = start.dup()
             focus.next(start)
             focus.call("doc:replace", 0, second, s, start, "")
             second=1
+            o += 1
             continue
-        repl = ''
-        while new and (new[0] in ' \t\n' or new[0] in strip):
+        i = n
+        while i < len(new) and (new[i] in ' \t\n' or new[i] in strip):
             # probably this was inserted
-            repl += new[0]
-            new = new[1:]
-        if repl:
+            i += 1
+        if i > n:
             s = start.dup()
-            focus.call("doc:replace", 0, second, s, start, repl)
+            focus.call("doc:replace", 0, second, s, start, new[n:i])
             second = 1
+            n = i
             continue
         # Nothing obvious to do, just bale out
         break
-    if start < end or new:
-        focus.call("doc:replace", 0, second, start, new, end)
+    if skip:
+        focus.call("doc:char", start, skip)
+    if o < len(old) or n < len(new):
+        focus.call("doc:replace", 0, second, start, new[n:], end)
 
 def reformat(lines, lln,  width, tostrip, prefix):
     # 'lines' is an array of lines
@@ -99,32 +101,36 @@ def reformat(lines, lln,  width, tostrip, prefix):
     for l in lines:
         p = span(l, tostrip)
         l = l[len(p):]
-        words.extend(re.split(r'\s+', l.strip()))
+        words.extend(l.split())
 
     # we have the words, time to assemble the lines
-    # first line never gets prefix
-    newpara = ""
-    ln = ""
+    # first line never gets prefix.
+    # Lines and the pieces of the current line are collected in lists
+    # and joined at the end, as repeated += gets slow on long paragraphs.
+    # split() never gives empty words, so a non-empty 'ln' holds text.
+    newpara = []
+    ln = []
 
     pfx = ''
     for w in words:
         spaces = 1
-        if ln and ln[-1] == '.':
+        if ln and ln[-1][-1] == '.':
             # 2 spaces after a sentence
             spaces = 2
         if ln and lln + spaces + len(w) > width:
             # time for a line break
-            newpara += pfx + ln + '\n'
-            ln = ""
+            newpara.append(pfx + ''.join(ln))
+            ln = []
             lln = plen
             pfx = prefix
         if ln:
-            ln += ' ' * spaces
+            ln.append(' ' * spaces)
             lln += spaces
-        ln += w
+        ln.append(w)
         lln += len(w)
 
-    return newpara + pfx + ln
+    newpara.append(pfx + ''.join(ln))
+    return '\n'.join(newpara)
 
 def find_start(focus, mark):
     mark = mark.dup()
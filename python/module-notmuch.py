@@ -37,6 +37,11 @@ import json
 import time
 import mimetypes
 
+# Pattern passed to "text-search" to find URLs in message text.
+# People sometimes put a period or close-paren after a URL, so the
+# last char cannot be one of those.
+url_pattern = "(http|https|ftp|mail):[^][\\s\":;<>]*[^][\\s\":;<>.)]"
+
 class notmuch_db():
     # This class is designed to be used with "with ... as"
 
@@ -2867,22 +2872,14 @@ class notmuch_message_view(edlib.Pane):
     def mark_urls(self, ms, me):
         while ms < me:
             try:
-                len = self.call("text-search",
-                                "(http|https|ftp|mail):[^][\\s\":;<>]+", ms, me)
-                len -= 1
+                ulen = self.call("text-search", url_pattern, ms, me)
+                ulen -= 1
             except:
                 return
-            # People sometimes put a period at the end of a URL.
-            while self.prior(ms) in '.':
-                self.prev(ms)
-                len -= 1
             m1 = ms.dup()
-            i = 0
-            while i < len:
-                self.prev(m1)
-                i += 1
+            self.call("doc:char", m1, -ulen)
             url = self.call("doc:get-str", m1, ms, ret='str')
-            self.call("doc:set-attr", 1, m1, "render:url", "%d" % len)
+            self.call("doc:set-attr", 1, m1, "render:url", "%d" % ulen)
             self.call("doc:set-attr", 1, m1, "url", url)
 
     def handle_notify_tag(self, key, **a):